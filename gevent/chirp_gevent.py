@@ -1,23 +1,31 @@
 #!/usr/bin/env python
 
 import datetime
-import json
 import logging
+import mimetypes
 import os
-import re
 import sys
 import time
 from collections import deque
 
+try:
+    # simplejson's C speedups are faster than the stdlib's json module
+    import simplejson as json
+except ImportError:
+    import json
+
 import gevent
 import pymongo
 from bson.objectid import ObjectId
-from socketio import socketio_manage
+from socketio import packet, socketio_manage
 from socketio.server import SocketIOServer
 from socketio.namespace import BaseNamespace
 
-# Global state: new chirps on the right, old ones fall off the left
+# Global state: new chirps on the right, old ones fall off the left. Each
+# chirp is a (ts, _id, JSON string) tuple, serialized once on arrival.
 chirps = deque([], maxlen=20)
+# The JSON for GET /chirps, or None if chirps changed since it was built
+chirps_json = None
 sessions = set()
 cursor_manager = None
 db = None
@@ -28,18 +36,72 @@ def create_collection():
     logging.info('Created capped collection "chirps" in database "test"')
 
 
-def json_default(obj):
+def json_default(obj, _OBJECTID=ObjectId, _DATETIME=datetime.datetime):
     """
     Convert non-JSON-serializable obj to something serializable
     """
-    if isinstance(obj, ObjectId):
+    # Exact-type checks for the common cases before the isinstance() ladder;
+    # the types are bound as default arguments so lookups are local
+    obj_type = type(obj)
+    if obj_type is _OBJECTID:
         return str(obj)
-    elif isinstance(obj, datetime.datetime):
+    elif obj_type is _DATETIME:
+        # Same format as str(obj), without the extra call through __str__
+        return obj.isoformat(' ')
+    elif isinstance(obj, _OBJECTID):
         return str(obj)
+    elif isinstance(obj, _DATETIME):
+        return obj.isoformat(' ')
     else:
         raise TypeError("%s is not JSON-serializable" % repr(obj))
 
 
+# One encoder for every document, rather than a new one per json.dumps() call.
+# Compact separators keep the messages small.
+json_encode = json.JSONEncoder(
+    default=json_default,
+    separators=(',', ':')
+).encode
+
+
+# The envelope around a "chirps" message never changes, so it's written by
+# hand instead of being serialized
+CHIRPS_HEAD = '{"chirps":['
+CHIRPS_TAIL = ']}'
+
+
+def chirps_message(fragments):
+    """
+    Splice JSON-encoded chirps into the {"chirps": [...]} envelope the client
+    expects
+    """
+    return CHIRPS_HEAD + ','.join(fragments) + CHIRPS_TAIL
+
+
+def add_chirp(doc):
+    """
+    Serialize a new chirp once, append it to the recent chirps and return its
+    JSON
+    """
+    global chirps_json
+    ts = doc['ts']
+
+    # Format the timestamp up front in a shallow copy of doc, so json_default
+    # is only called for the _id
+    fragment = json_encode(dict(doc, ts=ts.isoformat(' ')))
+
+    chirps.append((ts, doc['_id'], fragment))
+    chirps_json = None
+    return fragment
+
+
+def clear_chirps():
+    """Forget all recent chirps"""
+    global chirps_json
+    chirps.clear()
+    chirps_json = None
+
+
 class TailingHandler(BaseNamespace):
     def on_get_chirps(self):
         """Client starts waiting for new chirps"""
@@ -52,9 +114,13 @@ class TailingHandler(BaseNamespace):
 class ChirpsHandler(object):
     def get(self, env, start_response):
         """Get all recent chirps at once"""
-        logging.debug('Getting %d chirps' % len(chirps))
+        global chirps_json
+        logging.debug('Getting %d chirps', len(chirps))
+        if chirps_json is None:
+            chirps_json = '[' + ','.join(chirp[2] for chirp in chirps) + ']'
+
         start_response('200 OK', [('Content-Type', 'application/json')])
-        return [json.dumps(list(chirps), default=json_default)]
+        return [chirps_json]
 
 
 class CursorManager(gevent.greenlet.Greenlet):
@@ -63,30 +129,66 @@ class CursorManager(gevent.greenlet.Greenlet):
         super(CursorManager, self).__init__()
         self.db = db
 
+        # The tail query, updated in place to resume after the newest chirp
+        self.query = {'ts': {'$gte': None}, '_id': {'$ne': None}}
+
+        # JSON for chirps that have arrived but haven't been broadcast yet
+        self.pending = []
+
     def emit(self, name, value):
+        # Encode the socket.io packet once and send the same frame to every
+        # client, instead of having each namespace re-encode it
+        frame = packet.encode(
+            dict(type='event', name=name, args=[value], endpoint=''))
+
         for handler in sessions:
-            handler.emit(name, value)
+            handler.socket.put_client_msg(frame)
 
     def run(self):
         while True:
             if len(chirps):
-                last_chirp = chirps[-1]
-                query = {
-                    'ts': {'$gte': last_chirp['ts']},
-                    '_id': {'$ne': last_chirp['_id']}
-                }
+                last_ts, last_id, _ = chirps[-1]
+                self.query['ts']['$gte'] = last_ts
+                self.query['_id']['$ne'] = last_id
+                query = self.query
             else:
                 query = {}
 
-            response, error = None, None
-            try:
-                response = list(self.db.chirps.find(
-                    query,
-                    tailable=True
-                ))
-            except Exception, e:
-                logging.exception('chirps.find()')
-                error = e
+            cursor = self.db.chirps.find(
+                query,
+                tailable=True, await_data=True
+            )
+
+            # With await_data each get_more parks this greenlet on the socket
+            # until the server has new data or times out, so new chirps are
+            # broadcast as soon as they arrive, without polling.
+            error = None
+            while cursor.alive:
+                try:
+                    doc = next(cursor)
+                except StopIteration:
+                    # The get_more timed out without new data
+                    continue
+                except Exception, e:
+                    logging.exception('chirps.find()')
+                    error = e
+                    break
+
+                # Each decoded document is freed once it's serialized
+                fragment = add_chirp(doc)
+
+                # We have new data for the client.
+                logging.debug('New data: %.150s', fragment)
+
+                # Chirps arriving within 10ms of each other are batched into
+                # one broadcast
+                if not self.pending:
+                    gevent.spawn_later(0.01, self._flush)
+
+                self.pending.append(fragment)
+
+                # Let other greenlets run between documents during a burst
+                gevent.sleep(0)
 
             if error:
                 # Something's wrong with this cursor, wait 1 second before trying
@@ -96,25 +198,19 @@ class CursorManager(gevent.greenlet.Greenlet):
                 # Ignore errors from dropped collections
                 if not error.message.endswith('not valid at server'):
                     self.emit('app_error', error.message)
+            else:
+                # The server closed the cursor, e.g. because the collection was
+                # empty. Don't spin while waiting for the first chirp.
+                gevent.sleep(.1)
+
+    def _flush(self):
+        """Send all pending chirps to the clients in one message"""
+        if not self.pending:
+            # ClearChirpsHandler discarded them
+            return
 
-                return
-
-            elif response:
-                print 'CursorManager got', response
-                chirps.extend(response)
-
-                # We have new data for the client.
-                logging.debug('New data: ' + str(response)[:150])
-
-                self.emit(
-                    'chirps',
-                    json.dumps(
-                        {'chirps': response},
-                        default=json_default
-                    )
-                )
-
-            gevent.sleep(.1)
+        fragments, self.pending = self.pending, []
+        self.emit('chirps', chirps_message(fragments))
 
 
 class NewChirpHandler(object):
@@ -125,11 +221,10 @@ class NewChirpHandler(object):
         msg = env['wsgi.input'].read()
 
         # Note that this is a fire-and-forget insert, for speed. To be certain
-        # your inserts succeed, pass safe=True
+        # your inserts succeed, pass safe=True. PyMongo adds the _id.
         db.chirps.insert({
             'msg': msg,
             'ts': datetime.datetime.utcnow(),
-            '_id': ObjectId(),
         })
 
         start_response('200 OK', [])
@@ -142,36 +237,66 @@ class ClearChirpsHandler(object):
         Delete everything in the collection
         """
         db.chirps.drop()
-        chirps.clear()
+        clear_chirps()
         create_collection()
+
+        # Chirps waiting for _flush() were cleared too; don't let them reach
+        # the clients after 'cleared'
+        cursor_manager.pending = []
         cursor_manager.emit('cleared', {})
         start_response('200 OK', [])
         return []
 
 
 class StaticFileHandler(object):
+    def __init__(self, root='static'):
+        # The files don't change while the app runs, so read them all once and
+        # serve every request from memory. Keys are paths relative to the
+        # working directory, like 'static/chirp.js'.
+        self.cache = {}
+        cwd = os.getcwd()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(cwd, root)):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                content_type = (
+                    mimetypes.guess_type(path)[0] or 'application/octet-stream')
+
+                with open(path, 'rb') as f:
+                    self.cache[self._key(path, cwd)] = (f.read(), content_type)
+
+            # A directory is served by its index.html
+            if 'index.html' in filenames:
+                indexpath = os.path.join(dirpath, 'index.html')
+                self.cache[self._key(dirpath, cwd)] = \
+                    self.cache[self._key(indexpath, cwd)]
+
+    def _key(self, path, cwd):
+        return os.path.relpath(path, cwd).replace(os.sep, '/')
+
     def get(self, env, start_response):
-        # No, this is not secure.
         path = env['PATH_INFO']
         if not path or path == '/':
             path = 'static'
 
-        path = os.path.join(os.getcwd(), path.strip('/'))
-
-        if os.path.isdir(path):
-            indexpath = os.path.join(path, 'index.html')
-            if os.path.exists(indexpath):
-                path = indexpath
-
-        if os.path.isfile(path):
-            start_response('200 OK', [('Content-Type', 'text/html')])
-            with open(path) as f:
-                return [f.read()]
+        entry = self.cache.get(path.strip('/'))
+        if entry:
+            body, content_type = entry
+            start_response('200 OK', [('Content-Type', content_type)])
+            return [body]
 
         start_response('404 NOT FOUND', [('Content-Type', 'text/html')])
         return [path, ' not found']
 
 
+# One instance of each handler serves every request
+routes = {
+    '/chirps': ChirpsHandler(),
+    '/new': NewChirpHandler(),
+    '/clear': ClearChirpsHandler(),
+}
+static_file_handler = StaticFileHandler()
+
+
 if __name__ == '__main__':
     from gevent import monkey
     monkey.patch_socket() # patch_thread() is unnecessary w/ PyMongo 2.2
@@ -196,19 +321,11 @@ if __name__ == '__main__':
             socketio_manage(env, {'': TailingHandler})
             return
 
-        for urlpattern, handler_class in [
-            (r'/chirps', ChirpsHandler),
-            (r'/new', NewChirpHandler),
-            (r'/clear', ClearChirpsHandler),
-            (r'/(.*)', StaticFileHandler),
-        ]:
-            # No, this is not efficient.
-            match = re.match(urlpattern, path)
-            if match:
-                handler = handler_class()
-                methodname = env['REQUEST_METHOD'].lower()
-                method = getattr(handler, methodname)
-                return method(env, start_response)
+        # Anything that isn't one of the fixed routes is a static file
+        handler = routes.get(path, static_file_handler)
+        methodname = env['REQUEST_METHOD'].lower()
+        method = getattr(handler, methodname)
+        return method(env, start_response)
 
     print 'listening on port 8000'
     SocketIOServer(
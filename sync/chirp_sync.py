@@ -1,24 +1,35 @@
 #!/usr/bin/env python
 
 import datetime
-import json
 import logging
 import os
 import sys
 import time
 from collections import deque
 
+try:
+    # simplejson's C speedups are faster than the stdlib's json module
+    import simplejson as json
+except ImportError:
+    import json
+
 import tornado.ioloop
 import tornado.web
 import tornado.options
 import tornadio2
+from tornadio2 import proto
 import pymongo
 from bson.objectid import ObjectId
 
 
-# Global state: new chirps on the right, old ones fall off the left
+# Global state: new chirps on the right, old ones fall off the left. Each
+# chirp is a (ts, _id, JSON string) tuple, serialized once on arrival.
 chirps = deque([], maxlen=20)
-session2handler = {}
+# The JSON for GET /chirps, or None if chirps changed since it was built
+chirps_json = None
+# Connected clients waiting for chirps, as a plain list so broadcasting is a
+# linear scan
+handlers = []
 sync_db = None
 
 
@@ -27,35 +38,95 @@ def create_collection():
     logging.info('Created capped collection "chirps" in database "test"')
 
 
-def json_default(obj):
+def json_default(obj, _OBJECTID=ObjectId, _DATETIME=datetime.datetime):
     """
     Convert non-JSON-serializable obj to something serializable
     """
-    if isinstance(obj, ObjectId):
+    # Exact-type checks for the common cases before the isinstance() ladder;
+    # the types are bound as default arguments so lookups are local
+    obj_type = type(obj)
+    if obj_type is _OBJECTID:
         return str(obj)
-    elif isinstance(obj, datetime.datetime):
+    elif obj_type is _DATETIME:
+        # Same format as str(obj), without the extra call through __str__
+        return obj.isoformat(' ')
+    elif isinstance(obj, _OBJECTID):
         return str(obj)
+    elif isinstance(obj, _DATETIME):
+        return obj.isoformat(' ')
     else:
         raise TypeError("%s is not JSON-serializable" % repr(obj))
 
 
+# One encoder for every document, rather than a new one per json.dumps() call.
+# Compact separators keep the messages small.
+json_encode = json.JSONEncoder(
+    default=json_default,
+    separators=(',', ':')
+).encode
+
+
+# The envelope around a "chirps" message never changes, so it's written by
+# hand instead of being serialized
+CHIRPS_HEAD = '{"chirps":['
+CHIRPS_TAIL = ']}'
+
+
+def chirps_message(fragments):
+    """
+    Splice JSON-encoded chirps into the {"chirps": [...]} envelope the client
+    expects
+    """
+    return CHIRPS_HEAD + ','.join(fragments) + CHIRPS_TAIL
+
+
+def add_chirp(doc):
+    """
+    Serialize a new chirp once, append it to the recent chirps and return its
+    JSON
+    """
+    global chirps_json
+    ts = doc['ts']
+
+    # Format the timestamp up front in a shallow copy of doc, so json_default
+    # is only called for the _id
+    fragment = json_encode(dict(doc, ts=ts.isoformat(' ')))
+
+    chirps.append((ts, doc['_id'], fragment))
+    chirps_json = None
+    return fragment
+
+
+def clear_chirps():
+    """Forget all recent chirps"""
+    global chirps_json
+    chirps.clear()
+    chirps_json = None
+
+
 class TailingHandler(tornadio2.SocketConnection):
     @tornadio2.event
     def get_chirps(self):
         """Client starts waiting for new chirps"""
         logging.info('get chirps %s' % self.session.session_id)
-        session2handler[self.session.session_id] = self
+        if self not in handlers:
+            handlers.append(self)
 
     def on_close(self):
         logging.info('client disconnected %s' % self.session.session_id)
-        session2handler.pop(self.session.session_id, None)
+        if self in handlers:
+            handlers.remove(self)
 
 
 class ChirpsHandler(tornado.web.RequestHandler):
     def get(self):
         """Get all recent chirps at once"""
-        logging.debug('Getting %d chirps' % len(chirps))
-        self.write(json.dumps(list(chirps), default=json_default))
+        global chirps_json
+        logging.debug('Getting %d chirps', len(chirps))
+        if chirps_json is None:
+            chirps_json = '[' + ','.join(chirp[2] for chirp in chirps) + ']'
+
+        self.write(chirps_json)
 
 
 class CursorManager(object):
@@ -63,65 +134,70 @@ class CursorManager(object):
     def __init__(self, sync_db):
         self.sync_db = sync_db
 
+        # The tail query, updated in place to resume after the newest chirp
+        self.query = {'ts': {'$gte': None}, '_id': {'$ne': None}}
+
+        # Poll for new chirps every 100ms
+        self.periodic_callback = tornado.ioloop.PeriodicCallback(
+            self._find, 100)
+
     def start(self):
-        self._find()
+        self.periodic_callback.start()
 
     def emit(self, name, value):
-        for handler in session2handler.values():
-            handler.emit(name, value)
+        # Encode the socket.io packet once and send the same frame to every
+        # client, instead of having each handler re-encode it
+        frame = proto.event(None, name, None, value)
+        for handler in handlers:
+            if not handler.is_closed:
+                handler.session.send_message(frame)
 
     def _find(self):
         if len(chirps):
-            last_chirp = chirps[-1]
-            query = {
-                'ts': {'$gte': last_chirp['ts']},
-                '_id': {'$ne': last_chirp['_id']}
-            }
+            last_ts, last_id, _ = chirps[-1]
+            self.query['ts']['$gte'] = last_ts
+            self.query['_id']['$ne'] = last_id
+            query = self.query
         else:
             query = {}
 
-        response, error = None, None
-        try:
-            response = list(self.sync_db.chirps.find(
-                query,
-                tailable=True, await_data=True
-            ))
-        except Exception, e:
-            error = e
+        cursor = self.sync_db.chirps.find(
+            query,
+            tailable=True, await_data=True
+        )
+
+        fragments, error = [], None
+        while True:
+            try:
+                doc = next(cursor)
+            except StopIteration:
+                break
+            except Exception, e:
+                error = e
+                break
+
+            # Each decoded document is freed once it's serialized
+            fragments.append(add_chirp(doc))
+
+        if fragments:
+            # We have new data for the client.
+            logging.debug('New data: %.150s', fragments)
+
+            self.emit('chirps', chirps_message(fragments))
 
         if error:
             # Something's wrong with this cursor, wait 1 second before trying
             # again
+            self.periodic_callback.stop()
             tornado.ioloop.IOLoop.instance().add_timeout(
                 time.time() + 1,
-                self._find
+                self.periodic_callback.start
             )
 
             # Ignore errors from dropped collections
             if not error.message.endswith('not valid at server'):
                 self.emit('app_error', error.message)
 
-            return
-
-        elif response:
-            chirps.extend(response)
-
-            # We have new data for the client.
-            logging.debug('New data: ' + str(response)[:150])
-
-            self.emit(
-                'chirps',
-                json.dumps(
-                    {'chirps': response},
-                    default=json_default
-                )
-            )
-
-        tornado.ioloop.IOLoop.instance().add_timeout(
-            time.time() + 0.1,
-            self._find
-        )
-
 
 class NewChirpHandler(tornado.web.RequestHandler):
     def post(self):
@@ -132,11 +208,10 @@ class NewChirpHandler(tornado.web.RequestHandler):
         sync_db = self.settings['sync_db']
 
         # Note that this is a fire-and-forget insert, for speed. To be certain
-        # your inserts succeed, pass safe=True
+        # your inserts succeed, pass safe=True. PyMongo adds the _id.
         sync_db.chirps.insert({
             'msg': msg,
             'ts': datetime.datetime.utcnow(),
-            '_id': ObjectId(),
         })
 
 
@@ -146,7 +221,7 @@ class ClearChirpsHandler(tornado.web.RequestHandler):
         Delete everything in the collection
         """
         sync_db.chirps.drop()
-        chirps.clear()
+        clear_chirps()
         create_collection()
         self.settings['cursor_manager'].emit('cleared', {})
 